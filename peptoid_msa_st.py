@@ -1,10 +1,18 @@
+import json
+import re
 import numpy as np
+import pandas as pd
 import plotly.graph_objects as go
 import plotly.io as pio
-from io import BytesIO
 import streamlit as st
-import kaleido
-import copy
+
+try:
+    from numba import njit, prange
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+HEX_COLOR = r'^#[0-9a-fA-F]{6}$'
 
 
 # Allon Goldberg 
@@ -18,93 +26,139 @@ import copy
 #     peptoid residues, and export visualizations in PNG or SVG formats.
 
 
+if _NUMBA_AVAILABLE:
+    @njit(cache=True, parallel=True)
+    def _map_to_colors(arr, lut, out):
+        for i in prange(arr.shape[0]):
+            for j in range(arr.shape[1]):
+                out[i, j] = lut[arr[i, j]]
+
+def map_to_colors(seqs_array, color_idx_lut):
+    # Translate code ids to color indices; only very large MSAs are worth the
+    # numba thread start-up, everything else uses plain fancy indexing
+    if not _NUMBA_AVAILABLE or seqs_array.size <= 100_000:
+        return color_idx_lut[seqs_array]
+    out = np.empty_like(seqs_array)
+    _map_to_colors(seqs_array, color_idx_lut.astype(np.int32), out)
+    return out
+
+def _validate_fasta(quasi_file):
+    # Cheap check before any parsing: non-blank lines alternate header/sequence
+    # and every sequence has the same number of residues
+    lines = [line for line in quasi_file.splitlines() if line.strip()]
+    if not lines or len(lines) % 2:
+        return False
+    if not all(lines[i].startswith('>') == (i % 2 == 0) for i in range(len(lines))):
+        return False
+    return len({len(seq.split()) for seq in lines[1::2]}) == 1
+
 def read_fasta(quasi_file):
     names = []
     seqs = []
-    i_count = 0
-
-    split_file = quasi_file.splitlines()
-    for i in range(len(split_file)):
-        if i == 0:
-            if split_file[i].startswith(">"):  # Header line
-                names.append(split_file[i][1:])
-                i_count += 1
-                seqs.append(split_file[i+1])
-                i_count += 1
-        if i >= i_count:
-            if split_file[i].startswith(">"):  # Header line
-                names.append(split_file[i][1:])
-                i_count += 1
-                seqs.append(split_file[i+1])
-                i_count += 1
-        else:
-            continue
-        
-    return names, seqs
-
-def plot_msa_plotly(names, seqs, color_map, property_map):
-    seqs_array = np.array([[code for code in seq.split()] for seq in seqs])
-    
+
+    lines = (line for line in quasi_file.splitlines() if line.strip())
+    for line in lines:
+        if line.startswith(">"):  # Header line, sequence on the next line
+            names.append(line[1:].strip())
+            seqs.append(next(lines, ''))
+
+    # Tokenize once, mapping each residue code to a small int id
+    vocab = {}
+    rows = []
+    for seq in seqs:
+        rows.append([vocab.setdefault(code, len(vocab)) for code in seq.split()])
+    seqs_array = np.array(rows, dtype=np.int32)
+    code_vocab = list(vocab)  # id -> code, ids assigned in insertion order
+
+    return names, seqs_array, code_vocab
+
+def _sizing(M, N, margin, cell=22):
+    # Screen and export sizes both derive from one cell size; the screen size is
+    # capped to the viewport and the user zooms in-plot for detail
+    pad_w = margin['l'] + margin['r']
+    pad_h = margin['t'] + margin['b']
+    sw = max(300, min(1600, N * cell + pad_w))
+    sh = max(300, min(900, M * cell + pad_h))
+    ew = max(300, N * cell * 2 + pad_w)
+    eh = max(430, M * cell * 2 + pad_h)
+    return sw, sh, ew, eh
+
+def plot_msa_plotly(names, seqs_array, code_vocab, color_map, property_color_map, export=False):
     if seqs_array.ndim == 1:
         seqs_array = seqs_array.reshape(1, -1)
 
     len_seq, num_seq = seqs_array.shape
-    ratio_len = 0.05
-    ratio_num = 0.5
-    w = num_seq * 43
-    h = max(430,len_seq * 43)
-
-    property_color_map = {}
-    for idx, tuple in property_map.items():
-        code = tuple[0]
-        prop = tuple[1]
-        if prop not in property_color_map:
-            property_color_map[prop] = color_map.get(code, color_map['default'])
+    margin = dict(l=134, r=88, t=100, b=88)
+    plot_width, plot_height, w, h = _sizing(len_seq, num_seq, margin)
+
+    # Lookups are done once per distinct code rather than once per cell
+    default_color = color_map['default']
+
+    # Codes sharing a color collapse onto one stop of a discrete colorscale
+    color_lut = np.array([color_map.get(code, default_color) for code in code_vocab])
+    colors_unique, color_idx_lut = np.unique(color_lut, return_inverse=True)
+    z = map_to_colors(seqs_array, color_idx_lut)
+    n_colors = len(colors_unique)
+    if n_colors == 1:
+        colorscale = [[0, colors_unique[0]], [1, colors_unique[0]]]
+    else:
+        colorscale = [[i / (n_colors - 1), color] for i, color in enumerate(colors_unique)]
 
     # CREATE FIG
     fig = go.Figure()
 
-    for i in range(seqs_array.shape[0]):
-        for j in range(seqs_array.shape[1]):
-            code = seqs_array[i, j] 
-            color = color_map.get(code, color_map['default'])
-            prop = property_map.get(code, 'default') 
-
-            # Rectangles/boxes
-            fig.add_trace(go.Scatter(
-                x=[j, j + 1, j + 1, j],  
-                y=[i, i, i + 1, i + 1],  
-                fill='toself',            
-                fillcolor=color,
-                line=dict(color='rgba(0, 0, 0, 0)'),  
-                mode='lines',             
-                showlegend=False          
-            ))
-
-            # Text
-            fig.add_trace(go.Scatter(
-                x=[j + 0.5],             
-                y=[i + 0.5],             
-                text=[str(seqs_array[i, j])],  
-                mode='text',                
-                showlegend=False,
-                textfont=dict(size=9, color='black')
-            ))
+    # Rectangles/boxes
+    fig.add_trace(go.Heatmap(
+        z=z,
+        x=np.arange(num_seq) + 0.5,
+        y=np.arange(len_seq) + 0.5,
+        colorscale=colorscale,
+        zmin=0,
+        zmax=max(n_colors - 1, 1),
+        showscale=False,
+        hoverinfo='skip'
+    ))
+
+    # Text. On screen it is skipped when cells are too narrow to read; exports
+    # always get labels since _sizing gives their cells a fixed 44 px.
+    # Small MSAs use layout annotations; larger ones fall back to a text trace,
+    # drawn with WebGL on screen when big. Exports keep SVG text, since kaleido
+    # would flatten WebGL labels to a bitmap
+    cell_px = (plot_width - margin['l'] - margin['r']) / num_seq
+    show_labels = export or cell_px >= 10
+    annotations = []
+    if show_labels and seqs_array.size <= 1000:
+        annotations = [
+            dict(x=j + 0.5, y=i + 0.5, text=code_vocab[seqs_array[i, j]], showarrow=False,
+                 font=dict(size=9, color='black'), xref='x', yref='y')
+            for i in range(len_seq) for j in range(num_seq)
+        ]
+    elif show_labels:
+        xs, ys = np.meshgrid(np.arange(num_seq) + 0.5, np.arange(len_seq) + 0.5)
+        text_trace = go.Scattergl if seqs_array.size > 5000 and not export else go.Scatter
+        fig.add_trace(text_trace(
+            x=xs.ravel(),
+            y=ys.ravel(),
+            text=np.array(code_vocab)[seqs_array].ravel(),
+            mode='text',
+            showlegend=False,
+            hoverinfo='skip',
+            textfont=dict(size=9, color='black')
+        ))
 
     # Legend
     for prop, color in property_color_map.items():
-        if prop != '—':
-            fig.add_trace(go.Scatter(
-                x=[None], y=[None],  
-                mode='markers',
-                marker=dict(size=10, color=color),
-                name=prop 
-            ))
+        fig.add_trace(go.Scatter(
+            x=[None], y=[None],
+            mode='markers',
+            marker=dict(size=10, color=color),
+            name=prop
+        ))
 
     # Layout
     fig.update_layout(
         title='MSA Plot',
-        margin=dict(l=134, r=88, t=100, b=88),
+        margin=margin,
         xaxis=dict(
             tickmode='array',
             tickvals=np.arange(seqs_array.shape[1]) + 0.5,
@@ -121,14 +175,41 @@ def plot_msa_plotly(names, seqs, color_map, property_map):
             autorange="reversed",
             tickfont=dict(size=13)      
         ),
+        annotations=annotations,
         plot_bgcolor='white',         
-        autosize=False,               
-        width=max(300, ratio_num * num_seq * 888),  # Set plot width according to number of seqs
-        height=min(0.3*max(300, ratio_num * num_seq * 888), max(300, ratio_len * len_seq * 818)),  # Set plot height according to length of seqs
+        width=plot_width,
+        height=plot_height,
     )
 
     return fig, w, h
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def _cached_fig(names_t, seqs_array, vocab_t, cmap_t, propmap_t):
+    # Arguments are tuples so Streamlit can hash them; rebuild the maps here
+    cmap = dict(cmap_t)
+    propmap = dict(propmap_t)
+    fig, w, h = plot_msa_plotly(list(names_t), seqs_array, list(vocab_t), cmap, propmap)
+    export_fig, _, _ = plot_msa_plotly(list(names_t), seqs_array, list(vocab_t), cmap, propmap, export=True)
+    return fig.to_json(), export_fig.to_json(), w, h
+
+def _cmap_state_hash():
+    return hash(tuple((e['code'], e['prop'], e['color']) for e in st.session_state.cmap_entries))
+
+def _rebuild_cmap():
+    custom_cmap = {}
+    custom_propmap = {}  # Legend: property -> color, in entry order
+    for entry in st.session_state.cmap_entries:
+        if not re.match(HEX_COLOR, entry['color']):
+            continue  # Cleared or invalid colors would make plotly raise; codes fall back to default
+        for code in entry['code'].split():
+            custom_cmap[code] = entry['color']
+        if entry['prop'] and entry['prop'] != '—':
+            custom_propmap.setdefault(entry['prop'], entry['color'])
+    custom_cmap.setdefault('default', '#FFFFFF')  # The 'default' row may have been deleted
+    st.session_state.custom_cmap = custom_cmap
+    st.session_state.custom_propmap = custom_propmap
+    st.session_state.cmap_hash = _cmap_state_hash()
+
 
 # STREAMLIT SETUP
 st.set_page_config(layout='wide', page_title = 'Peptoid MSA')
@@ -137,11 +218,6 @@ st.markdown('''
         .block-container{
             width: 72%;  
         }
-        .button-title{
-            margin-bottom: 3px;
-            font-weight: thin;
-            color: white;
-        }
         .center-button {
             display: flex;
             justify-content: center;
@@ -174,129 +250,93 @@ if 'custom_cmap' not in st.session_state:
     st.session_state.custom_cmap = {}
 if 'custom_propmap' not in st.session_state:
     st.session_state.custom_propmap = {}
-if 'standard_entries' not in st.session_state:
-    st.session_state.standard_entries = {
-        'chiral_hydrophobic': {'code': '601 602 621 622 623 624', 'prop': 'Chiral Hydrophobic', 'color': '#B95C00'},
-        'hydrophobic': {'code': '001 003 005 007 020 101 103 127 130 202 203 208 210 211', 'prop': 'Hydrophobic', 'color': '#FFAF22'},
-        'chiral_polar': {'code': '631 632 633 634', 'prop': 'Chiral Polar', 'color': '#0091B9'},
-        'polar': {'code': '303 307 ', 'prop': 'Polar', 'color': '#88CFFF'},
-        'polar_hydrophobic': {'code': '129', 'prop': 'Polar+Hydrophobic', 'color': '#C06EF7'},
-        'negative': {'code': '314', 'prop': 'Negative', 'color': '#F95B5E'},
-        'positive': {'code': '332 333', 'prop': 'Positive', 'color': '#5B75F9'},
-        'pro': {'code': 'PRO', 'prop': 'Proline', 'color': '#B8B8B8'},
-        'hyp': {'code': 'HYP', 'prop': 'Hydroxyproline', 'color': '#ABC5C5'},
-        'sar': {'code': 'SAR', 'prop': 'Sarcosine', 'color': '#F9ECB3'},
-        'default': {'code': 'default', 'prop': '', 'color': '#FFFFFF'}
-    }
-if 'skip_indices' not in st.session_state:
-    st.session_state.skip_indices = []
-if 'added_entries' not in st.session_state:
-    st.session_state.added_entries = []
-if 'rows' not in st.session_state:
-    st.session_state.rows = {}
-if 'rows_added' not in st.session_state:
-    st.session_state.rows_added = {}
-
-se_ids = ['chiral_hydrophobic', 'hydrophobic', 'chiral_polar', 'polar', 'polar_hydrophobic', 'negative', 'positive', 'pro', 'hyp', 'sar', 'default']
-rows = st.session_state.rows
-for i in range(len(se_ids)):
-    col_obj = st.columns([2, 6, 2, 1])
-    rows[i] = col_obj
-st.session_state.rows = rows
-se = st.session_state.standard_entries
-for i, cols in rows.items():
-    with cols[0]:
-        se[se_ids[i]]['code'] = st.text_input('Enter 3-letter codes:', value=se[se_ids[i]]['code'], key=f'{se_ids[i]}_codes')
-    with cols[1]:
-        se[se_ids[i]]['prop'] = st.text_input('Describe properties for legend (ex: Chiral Hydrophobic):', value=se[se_ids[i]]['prop'], key=f'{se_ids[i]}_props')
-    with cols[2]:
-        se[se_ids[i]]['color'] = st.color_picker('Select color:', value=se[se_ids[i]]['color'], key=f'{se_ids[i]}_color')
-st.session_state.standard_entries = se
-
-for idx, entry in enumerate(st.session_state.standard_entries):
-        code_vect = st.session_state.standard_entries[entry]['code'].split()
-        for i in range(len(code_vect)):
-            st.session_state.custom_cmap[code_vect[i]] = st.session_state.standard_entries[entry]['color']
-            # st.session_state.custom_propmap[code_vect[i]] = st.session_state.standard_entries[entry]['prop']
-            st.session_state.custom_propmap[idx] = [code_vect[i],st.session_state.standard_entries[entry]['prop']]   
-
-rows_added = st.session_state.rows_added
-for i in range(len(st.session_state.added_entries)-len(st.session_state.skip_indices)):
-    col_obj = st.columns([2, 6, 2, 1])
-    rows_added[i] = col_obj
-st.session_state.rows_added = rows_added
-i_row_added = 0
-for idx, entry in enumerate(st.session_state.added_entries):
-    if idx in st.session_state.skip_indices:
-            continue
-    with rows_added[i_row_added][0]:
-        entry['code'] = st.text_input('Enter 3-letter codes:', key=f'code_input{idx}')
-    with rows_added[i_row_added][1]:
-        entry['prop'] = st.text_input('Describe properties for legend (ex: Chiral Hydrophobic):', key=f'prop_input{idx}')
-    with rows_added[i_row_added][2]:
-        entry['color'] = st.color_picker('Select color:', value=entry['color'], key=f'color_input{idx}') 
-    with rows_added[i_row_added][3]:
-        st.markdown("<p class='button-title'>Delete</p>", unsafe_allow_html=True)
-        if st.button('x', key=f'delete_button{idx}'):
-            st.session_state.skip_indices.append(idx)
-            st.rerun()
-    i_row_added += 1
-
-if st.button('\+ Add Entry'):
-    st.session_state.added_entries.append({
-        'code': '',
-        'prop': '',
-        'color': '#ffffff'
-    })
-    st.rerun()
-
-col1b, col2b, col3b, col4b = st.columns([2, 3, 1, 4])
-with col1b:
-    if st.button('Update Color Map'):
-        for idx, entry in enumerate(st.session_state.standard_entries):
-            code_vect = st.session_state.standard_entries[entry]['code'].split()
-            for i in range(len(code_vect)):
-                st.session_state.custom_cmap[code_vect[i]] = st.session_state.standard_entries[entry]['color']
-                # st.session_state.custom_propmap[code_vect[i]] = st.session_state.standard_entries[entry]['prop']
-                st.session_state.custom_propmap[idx] = [code_vect[i],st.session_state.standard_entries[entry]['prop']]
-        for i in range(len(st.session_state.added_entries)):
-            added_row = st.session_state.added_entries[i]
-            st.session_state.custom_cmap[added_row['code']] = added_row['color']
-            st.session_state.custom_propmap[i] = [added_row['code'], added_row['prop']]
-with col4b:
+if 'cmap_df' not in st.session_state:
+    # Initial rows of the editor; edits live in the 'cmap_editor' widget state
+    st.session_state.cmap_df = pd.DataFrame([
+        {'code': '601 602 621 622 623 624', 'prop': 'Chiral Hydrophobic', 'color': '#B95C00'},
+        {'code': '001 003 005 007 020 101 103 127 130 202 203 208 210 211', 'prop': 'Hydrophobic', 'color': '#FFAF22'},
+        {'code': '631 632 633 634', 'prop': 'Chiral Polar', 'color': '#0091B9'},
+        {'code': '303 307 ', 'prop': 'Polar', 'color': '#88CFFF'},
+        {'code': '129', 'prop': 'Polar+Hydrophobic', 'color': '#C06EF7'},
+        {'code': '314', 'prop': 'Negative', 'color': '#F95B5E'},
+        {'code': '332 333', 'prop': 'Positive', 'color': '#5B75F9'},
+        {'code': 'PRO', 'prop': 'Proline', 'color': '#B8B8B8'},
+        {'code': 'HYP', 'prop': 'Hydroxyproline', 'color': '#ABC5C5'},
+        {'code': 'SAR', 'prop': 'Sarcosine', 'color': '#F9ECB3'},
+        {'code': 'default', 'prop': '', 'color': '#FFFFFF'}
+    ])
+
+# Editor widgets rerun on their own, without re-executing the rest of the script
+@st.fragment
+def _cmap_editor():
+    edited = st.data_editor(
+        st.session_state.cmap_df,
+        column_config={
+            'code': st.column_config.TextColumn('3-letter codes', help='Space-separated codes, ex: 601 602 PRO', default=''),
+            'prop': st.column_config.TextColumn('Properties for legend', help='ex: Chiral Hydrophobic', default=''),
+            'color': st.column_config.TextColumn('Color', help='Hex color, ex: #B95C00', default='#FFFFFF', required=True, validate=HEX_COLOR)
+        },
+        num_rows='dynamic',
+        hide_index=True,
+        use_container_width=True,
+        key='cmap_editor'
+    )
+    st.session_state.cmap_entries = edited.fillna('').to_dict('records')
+
+    # Only rebuild the maps when an entry actually changed since the last build
+    if st.session_state.get('cmap_hash') != _cmap_state_hash():
+        _rebuild_cmap()
+
     # Show the current color mappings
-    if st.session_state.custom_cmap:
-        st.subheader('Current Color Mapping:')
-        with st.expander("Show Color Map", expanded=False):
-            st.write(st.session_state.custom_cmap)
+    _, col_map = st.columns([6, 4])
+    with col_map:
+        if st.session_state.custom_cmap:
+            st.subheader('Current Color Mapping:')
+            with st.expander("Show Color Map", expanded=False):
+                st.write(st.session_state.custom_cmap)
+
+_cmap_editor()
 
 st.markdown('<br>', unsafe_allow_html=True)
 
-def save_plot(fig, w, h, format="png"):
-    buf = BytesIO()
-    fig.write_image(buf, format=format, width=w, height=h, scale=3)
-    return buf
+def save_plot(fig_dict, w, h, format="png"):
+    # Scale only matters when rasterizing; SVG is exported at native size
+    scale = 3 if format == 'png' else 1
+    # Export the already-built figure dict directly, skipping Figure re-validation
+    return pio.to_image(fig_dict, format=format, width=w, height=h, scale=scale, validate=False)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def save_plots(fig_json, w, h):
+    fig_dict = json.loads(fig_json)
+    return save_plot(fig_dict, w, h, 'png'), save_plot(fig_dict, w, h, 'svg')
 
 st.markdown('# MSA Plot')
 
 # MSA PLOT MODULES
 if st.button('Show MSA'):
-    if input_fasta[0] == '>':
-        names, seqs = read_fasta(input_fasta)
+    if _validate_fasta(input_fasta):
+        names, seqs_array, code_vocab = read_fasta(input_fasta)
         st.write('Analysing...')
-        fig, w, h = plot_msa_plotly(names, seqs, st.session_state.custom_cmap, st.session_state.custom_propmap)
-        st.plotly_chart(fig, use_container_width=False)
+        fig_json, export_json, w, h = _cached_fig(
+            tuple(names),
+            seqs_array,
+            tuple(code_vocab),
+            tuple(sorted(st.session_state.custom_cmap.items())),
+            tuple(st.session_state.custom_propmap.items())
+        )
+        st.plotly_chart(json.loads(fig_json), use_container_width=False)
+        png_bytes, svg_bytes = save_plots(export_json, w, h)
         col1c, col2c, col3c, col4c = st.columns(4)
         with col1c:
             st.write('Download buttons:')
         with col2c:
-            st.download_button('PNG', save_plot(fig, w, h, 'png').getvalue(), 'msa.png', 'image/png', help='Click to download as .png')
+            st.download_button('PNG', png_bytes, 'msa.png', 'image/png', help='Click to download as .png')
         with col3c:
-            st.download_button('SVG', save_plot(fig, w, h, 'svg').getvalue(), 'msa.svg', 'image/svg+xml', help='Click to download as .svg')
+            st.download_button('SVG', svg_bytes, 'msa.svg', 'image/svg+xml', help='Click to download as .svg')
         with col4c:
             st.download_button('FASTA', data=input_fasta, file_name='sequences.fasta', mime='text/plain', help='Click to download sequences as fasta file')
     else:
-        st.write('''Make sure you paste a FASTA sequence in the proper format, for example:\n
+        st.error('''Make sure you paste an aligned FASTA sequence (all sequences the same length) in the proper format, for example:\n
     > name1\n
     sequence1\n
     > name2\n